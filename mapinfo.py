@@ -11,9 +11,7 @@ from requests import get
 from PIL import Image, ImageDraw
 from json.decoder import JSONDecodeError
 from simplejson.errors import JSONDecodeError as simpleJSONDecodeError
-from urllib.error import URLError
-from urllib.request import urlretrieve
-from requests.exceptions import ReadTimeout, ConnectTimeout
+from requests.exceptions import ReadTimeout, ConnectTimeout, HTTPError, ConnectionError as RequestsConnectionError
 from math import radians, degrees, sqrt, sin, asin, cos, atan2
 from WTwebdev.maps import maps
 
@@ -455,15 +453,28 @@ class map_obj(object):
 
 
 class MapInfo(object):
-    def __init__(self):
+    def __init__(self, http=None):
+        '''
+        Args:
+            http:
+                Optional requests.Session to reuse pooled connections for
+                all map queries (plain requests.get is used otherwise)
+        '''
+        
         self.map_valid = False
         self.map_objs  = []
+        self._get      = http.get if http is not None else get
     
-    def download_files(self) -> bool:
+    def download_files(self, info: dict = None) -> bool:
         '''
         Sample information about the map and the "seen" objects in the match
         from the localhost
         
+        Args:
+            info:
+                Already downloaded contents of {URL_MAP_INFO} (optional,
+                queried from the localhost if not given)
+        
         Example self.info - 
         {'grid_steps': [8192.0, 8192.0],
          'grid_zero': [-28672.0, 28672.0],
@@ -501,9 +512,15 @@ class MapInfo(object):
         self.map_valid = False
         
         try:
-            urlretrieve(URL_MAP_IMG, MAP_PATH)
-            self.info = get(URL_MAP_INFO, timeout=REQUEST_TIMEOUT).json()
-            self.obj  = get(URL_MAP_OBJ,  timeout=REQUEST_TIMEOUT).json()
+            map_img_response = self._get(URL_MAP_IMG, timeout=REQUEST_TIMEOUT)
+            map_img_response.raise_for_status() # keep the last good map.jpg
+            with open(MAP_PATH, 'wb') as map_file:
+                map_file.write(map_img_response.content)
+            
+            if info is None:
+                info = self._get(URL_MAP_INFO, timeout=REQUEST_TIMEOUT).json()
+            self.info = info
+            self.obj  = self._get(URL_MAP_OBJ,  timeout=REQUEST_TIMEOUT).json()
             self.parse_meta()
             
             self.map_img  = Image.open(MAP_PATH)
@@ -513,19 +530,43 @@ class MapInfo(object):
             
             self.map_valid = True
                 
-        except URLError:
-            print('ERROR: could not download map.jpg')
-    
-        except (OSError, JSONDecodeError, simpleJSONDecodeError):
-            print('Waiting to join a match')
-            sleep(1)
-            
         except ReadTimeout:
             print('ERROR: ReadTimeout')
             
         except ConnectTimeout:
             print('ERROR: ConnectTimeout')
             
+        except (RequestsConnectionError, HTTPError):
+            print('ERROR: could not download map.jpg')
+    
+        except (OSError, JSONDecodeError, simpleJSONDecodeError):
+            print('Waiting to join a match')
+            sleep(1)
+            
+        return self.map_valid
+    
+    def download_objs(self) -> bool:
+        '''
+        Sample only the "seen" objects in the match from the localhost,
+        reusing the map image and grid info from the last call to
+        download_files()
+        
+        Returns:
+                Whether or not the object data was successfully retrieved
+        '''
+        
+        if not self.map_valid:
+            return self.download_files()
+        
+        try:
+            self.obj = self._get(URL_MAP_OBJ, timeout=REQUEST_TIMEOUT).json()
+            self.parse_meta()
+        
+        except (ReadTimeout, ConnectTimeout, RequestsConnectionError,
+                OSError, JSONDecodeError, simpleJSONDecodeError):
+            self.map_valid = False
+            self.parse_meta()
+        
         return self.map_valid
     
     def check_battle(self, player_pos: bool = False) -> bool:
@@ -539,10 +580,10 @@ class MapInfo(object):
         in_battle = False
 
         try:
-            data1 = get(URL_MAP_OBJ,  timeout=REQUEST_TIMEOUT)
+            data1 = self._get(URL_MAP_OBJ,  timeout=REQUEST_TIMEOUT)
             if player_pos:
                 sleep(1)
-                data2 = get(URL_MAP_OBJ,  timeout=REQUEST_TIMEOUT)
+                data2 = self._get(URL_MAP_OBJ,  timeout=REQUEST_TIMEOUT)
                 data1 = data1.json()
                 data2 = data2.json()
                 in_battle = not self.compare_player_pos(data1, data2)
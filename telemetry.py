@@ -4,22 +4,36 @@ Module to query and access telemetry data during War Thunder matches
 
 
 import socket
-from requests import get
-from requests.exceptions import ConnectTimeout
+from collections.abc import Mapping
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectTimeout, ReadTimeout, ConnectionError as RequestsConnectionError
 from WTwebdev import mapinfo
 
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
 
 # IP_ADDRESS     = socket.gethostbyname(socket.gethostname())
 IP_ADDRESS   = "127.0.0.1"
 URL_INDICATORS = 'http://{}:8111/indicators'.format(IP_ADDRESS)
 URL_STATE      = 'http://{}:8111/state'.format(IP_ADDRESS)
-URL_COMMENTS   = 'http://{}:8111/gamechat?lastId={}'
-URL_EVENTS     = 'http://{}:8111/hudmsg?lastEvt=-1&lastDmg={}'
+URL_COMMENTS   = 'http://{}:8111/gamechat'.format(IP_ADDRESS)
+URL_EVENTS     = 'http://{}:8111/hudmsg'.format(IP_ADDRESS)
+REQUEST_TIMEOUT = (0.2, 1.0) # (connect, read) seconds
+JSON_HEADERS   = {'Accept': 'application/json'}
 FT_TO_M        = 0.3048
-METRICS_PLANES = ['p-', 'f-', 'f2', 'f3', 'f4', 'f6', 'f7', 'f8', 'f9', 'os',
-                  'sb', 'tb', 'a-', 'pb', 'am', 'ad', 'fj', 'b-', 'b_', 'xp',
-                  'bt', 'xa', 'xf', 'sp', 'hu', 'ty', 'fi', 'gl', 'ni', 'fu',
-                  'fu', 'se', 'bl', 'be', 'su', 'te', 'st', 'mo', 'we', 'ha']
+MAP_CACHE_VERSION = 1 # bump to invalidate cached map data after format changes
+STATUS_REVALIDATE_POLLS = 10 # in-flight get_status() calls between full checks
+METRICS_PLANES = frozenset(['p-', 'f-', 'f2', 'f3', 'f4', 'f6', 'f7', 'f8', 'f9', 'os',
+                            'sb', 'tb', 'a-', 'pb', 'am', 'ad', 'fj', 'b-', 'b_', 'xp',
+                            'bt', 'xa', 'xf', 'sp', 'hu', 'ty', 'fi', 'gl', 'ni', 'fu',
+                            'se', 'bl', 'be', 'su', 'te', 'st', 'mo', 'we', 'ha'])
+ALTITUDE_KEYS  = ('altitude_10k', 'altitude_hour', 'altitude_min')
 
 class Status:
     IN_FLIGHT      = 0
@@ -29,43 +43,186 @@ class Status:
     OTHER_ERROR    = -4
 
 
-def combine_dicts(to_dict: dict, from_dict: dict) -> dict:
+class BasicTelemetry(Mapping):
     '''
-    Merges all contents of "from_dict" into "to_dict"
-    
-    Args:
-        to_dict:
-            One dictionary to be merged
-        from_dict:
-            Other dictionary to be merged
+    Minimal amount of telemetry needed for navigation and control. Fields can
+    be read as attributes (i.e. basic_telemetry.airframe) or as a read-only
+    mapping (i.e. basic_telemetry['airframe'], basic_telemetry.get('IAS'),
+    'IAS' in basic_telemetry, dict(basic_telemetry))
     
-    Returns:
-            Dictionary with the merged contents of the original to_dict and
-            from_dict
+    Like the dictionary it replaces, the mapping only holds the fields that
+    were given (BasicTelemetry() is empty and falsy). Fields that were not
+    given read as None when accessed as attributes
     '''
     
-    if (type(to_dict) == dict) and (type(from_dict) == dict):
-        for key in from_dict.keys():
-            to_dict[key] = from_dict[key]
+    FIELDS    = ('airframe', 'roll', 'pitch', 'altitude', 'lat', 'lon',
+                 'IAS', 'flapState', 'gearState')
+    __slots__ = FIELDS + ('_keys',)
+    
+    def __init__(self, **fields):
+        unknown = set(fields) - set(self.FIELDS)
+        if unknown:
+            raise TypeError('Unknown BasicTelemetry fields: {}'.format(sorted(unknown)))
+        
+        # instances are shared with latest_telemetry() readers, so fields
+        # are only set here and are read-only afterwards
+        set_field = object.__setattr__
+        for key in self.FIELDS:
+            set_field(self, key, fields.get(key))
+        set_field(self, '_keys', tuple(key for key in self.FIELDS if key in fields))
+    
+    def __setattr__(self, name: str, value):
+        raise AttributeError('BasicTelemetry is read-only')
+    
+    def __delattr__(self, name: str):
+        raise AttributeError('BasicTelemetry is read-only')
+    
+    def __getitem__(self, key: str):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __iter__(self):
+        return iter(self._keys)
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def __reduce__(self):
+        # rebuild through __init__ since __setattr__ is disabled
+        return (_rebuild_basic_telemetry, (self.to_dict(),))
+    
+    def __repr__(self):
+        fields = ', '.join('{}={!r}'.format(key, getattr(self, key)) for key in self._keys)
+        return 'BasicTelemetry({})'.format(fields)
+    
+    def to_dict(self) -> dict:
+        '''
+        Returns:
+                Dictionary with all given telemetry fields
+        '''
+        
+        return {key: getattr(self, key) for key in self._keys}
+
 
-        return to_dict
-    else:
-        return {}
+def _rebuild_basic_telemetry(fields: dict) -> BasicTelemetry:
+    return BasicTelemetry(**fields)
 
 
 class TelemInterface(object):
     def __init__(self):
         self.connected       = False
         self.full_telemetry  = {}
-        self.basic_telemetry = {}
+        self.basic_telemetry = BasicTelemetry()
         self.indicators      = {}
         self.state           = {}
-        self.map_info        = mapinfo.MapInfo()
         self.last_event_ID   = -1
         self.last_comment_ID = -1
         self.comments        = []
         self.events          = []
         self.status          = Status.WT_NOT_RUNNING
+        self._map_cache_key  = None
+        self._status_hint    = Status.WT_NOT_RUNNING
+        self._status_fast_polls = 0
+        self._latest         = BasicTelemetry()
+        self._poll_thread    = None
+        self._poll_stop      = Event()
+        self._poll_lock      = Lock() # serializes polls from any thread
+        
+        # reuse pooled localhost sockets across polls
+        self.http = Session()
+        self.http.mount('http://', HTTPAdapter(pool_connections=2,
+                                               pool_maxsize=8,
+                                               pool_block=False,
+                                               max_retries=0))
+        # gzip only costs CPU over loopback
+        self.http.headers.update({'Connection':      'keep-alive',
+                                  'Accept-Encoding': 'identity'})
+        
+        self.map_info = mapinfo.MapInfo(self.http)
+        
+        # the telemetry endpoints are independent, so poll them in parallel
+        self._pool = ThreadPoolExecutor(max_workers=5)
+    
+    def close(self):
+        '''
+        Stop background polling, close the HTTP session and release its
+        pooled connections
+        '''
+        
+        self.stop_polling()
+        self._pool.shutdown(wait=False)
+        self.http.close()
+    
+    def start_polling(self, period: float = 0.1, comments: bool = False, events: bool = False):
+        '''
+        Start a background thread that calls get_telemetry() every "period"
+        seconds and publishes the newest basic telemetry for
+        latest_telemetry()
+        
+        Polls from any thread are serialized, so calling get_telemetry() or
+        get_status() directly is still safe, but attributes such as
+        self.basic_telemetry are reset at the start of every poll. Read
+        latest_telemetry() instead while the poller is running
+        
+        Args:
+            period:
+                Seconds to wait between polls
+            comments:
+                Whether or not to query for match comment data
+            events:
+                Whether or not to query for match event data
+        '''
+        
+        if self._poll_thread and self._poll_thread.is_alive():
+            return
+        
+        self._poll_stop.clear()
+        self._poll_thread = Thread(target=self._poll_loop,
+                                   args=(period, comments, events),
+                                   daemon=True)
+        self._poll_thread.start()
+    
+    def stop_polling(self):
+        '''
+        Stop the background thread started by start_polling() (if any)
+        '''
+        
+        self._poll_stop.set()
+        
+        if self._poll_thread:
+            self._poll_thread.join()
+            self._poll_thread = None
+    
+    def _poll_loop(self, period: float, comments: bool, events: bool):
+        while not self._poll_stop.is_set():
+            # snapshot under the same lock as the poll so a direct
+            # get_status() can't reset basic_telemetry in between
+            with self._poll_lock:
+                if self._poll_telemetry(comments, events):
+                    self._latest = self.basic_telemetry
+                else:
+                    self._latest = BasicTelemetry()
+            
+            self._poll_stop.wait(period)
+    
+    def latest_telemetry(self):
+        '''
+        Return the newest basic telemetry published by the background poller
+        without any network I/O (see start_polling())
+        
+        Returns:
+                Basic telemetry from the newest poll (empty if the player is
+                not in a match)
+        '''
+        
+        return self._latest
+    
+    def __del__(self):
+        try:
+            self.close()
+        except AttributeError:
+            pass
     
     def get_comments(self) -> list:
         '''
@@ -76,24 +233,45 @@ class TelemInterface(object):
                 List of comments
         '''
         
-        comments_response = get(URL_COMMENTS.format(IP_ADDRESS, self.last_comment_ID))
-        self.comments.extend(comments_response.json())
-        if self.comments:
-            self.last_comment_ID = max([comment['id'] for comment in self.comments])
+        with self._poll_lock:
+            return self._poll_comments()
+    
+    def _poll_comments(self) -> list:
+        '''
+        Unlocked body of get_comments()
+        '''
+        
+        comments_response = self.http.get(f'{URL_COMMENTS}?lastId={self.last_comment_ID}',
+                                          headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+        new_comments      = loads(comments_response.content)
+        if new_comments:
+            self.last_comment_ID = max(self.last_comment_ID,
+                                       max(comment['id'] for comment in new_comments))
+            self.comments.extend(new_comments)
         return self.comments
     
     def get_events(self) -> list:
         '''
         Query http://localhost:8111/hudmsg?lastEvt=-1&lastDmg=-1 to get
         information on all events (i.e. when someone is damaged or destroyed)
-        in the current match
+        in the current match. After the first call only events newer than
+        the last one seen are requested
         
         Returns:
                 Events log dictionary
         '''
+        
+        with self._poll_lock:
+            return self._poll_events()
+    
+    def _poll_events(self) -> list:
+        '''
+        Unlocked body of get_events()
+        '''
         try:
-            events_response = get(URL_EVENTS.format(IP_ADDRESS, self.last_event_ID))
-            self.events.extend(events_response.json()['damage'])
+            events_response = self.http.get(f'{URL_EVENTS}?lastEvt={self.last_event_ID}&lastDmg={self.last_event_ID}',
+                                            headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+            self.events.extend(loads(events_response.content)['damage'])
         except Exception: pass
 
         
@@ -103,6 +281,40 @@ class TelemInterface(object):
         
         return self.events
     
+    def _update_map(self):
+        '''
+        Refresh the map objects, only re-downloading the map image and grid
+        info when http://localhost:8111/map_info.json reports a new map
+        '''
+        
+        try:
+            info_response = self.http.get(mapinfo.URL_MAP_INFO, headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+        except OSError:
+            # can't tell if the map changed, so fall back to a full download
+            self._map_cache_key = None
+            if self.map_info.download_files():
+                self.map_info.parse_meta()
+            return
+        
+        cache_key = (MAP_CACHE_VERSION, info_response.content)
+        
+        if self.map_info.map_valid and (cache_key == self._map_cache_key):
+            self.map_info.download_objs()
+            return
+        
+        try:
+            info = loads(info_response.content)
+        except ValueError:
+            info = None # let download_files() query and report it
+        
+        # download_files() parses the objects before the map is marked valid,
+        # so parse them again to find the player
+        if self.map_info.download_files(info):
+            self.map_info.parse_meta()
+            self._map_cache_key = cache_key
+        else:
+            self._map_cache_key = None
+    
     def find_altitude(self) -> float:
         '''
         Finds and standardizes reported alittude to meters for all planes
@@ -111,27 +323,20 @@ class TelemInterface(object):
                 Altitude in meters
         '''
         
-        name = self.indicators['type']
+        indicators = self.indicators
         
         # account for freedom units in US and UK planes
-        if name[:2] in METRICS_PLANES:
-            if 'altitude_10k' in self.indicators.keys():
-                return self.indicators['altitude_10k'] * FT_TO_M
-            elif 'altitude_hour' in self.indicators.keys():
-                return self.indicators['altitude_hour'] * FT_TO_M
-            elif 'altitude_min' in self.indicators.keys():
-                return self.indicators['altitude_min'] * FT_TO_M
-            else:
-                return 0
+        if indicators['type'][:2] in METRICS_PLANES:
+            factor = FT_TO_M
         else:
-            if 'altitude_10k' in self.indicators.keys():
-                return self.indicators['altitude_10k']
-            elif 'altitude_hour' in self.indicators.keys():
-                return self.indicators['altitude_hour']
-            elif 'altitude_min' in self.indicators.keys():
-                return self.indicators['altitude_min']
-            else:
-                return 0
+            factor = 1
+        
+        for key in ALTITUDE_KEYS:
+            altitude = indicators.get(key)
+            if altitude is not None:
+                return altitude * factor
+        
+        return 0
 
     def get_telemetry(self, comments: bool = False, events: bool = False) -> bool:
         '''
@@ -139,14 +344,14 @@ class TelemInterface(object):
         to sample telemetry data. Each one of the URL requests returns a
         respective JSON string. These two JSON strings are converted into
         dictionaries (self.indicators and self.state). From these dictionaries,
-        two more dictionaries are created: self.full_telemetry and
-        self.basic_telemetry.
+        self.full_telemetry and self.basic_telemetry are created.
         
         Dictionary self.full_telemetry holds a combination of all telemetry
         values returned from http://localhost:8111/indicators and
-        http://localhost:8111/state. Dictionary self.basic_telemetry holds
+        http://localhost:8111/state. BasicTelemetry self.basic_telemetry holds
         the minimal amount of telmetry needed for navigation and control (see
-        file docstring for more info)
+        BasicTelemetry for more info). self.basic_telemetry is empty while the
+        player is not in a match
         
         Args:
             comments:
@@ -158,73 +363,71 @@ class TelemInterface(object):
                 Whether or not player is in a match
         '''
         
+        with self._poll_lock:
+            return self._poll_telemetry(comments, events)
+    
+    def _poll_telemetry(self, comments: bool = False, events: bool = False) -> bool:
+        '''
+        Unlocked body of get_telemetry()
+        '''
+        
         self.connected       = False
         self.full_telemetry  = {}
-        self.basic_telemetry = {}
+        self.basic_telemetry = BasicTelemetry()
 
-        try:
-            self.map_info.download_files()
-            self.map_info.parse_meta()
-            
-            indicator_response = get(URL_INDICATORS)
-            self.indicators    = indicator_response.json()
+        futures = []
 
-            state_response = get(URL_STATE)
-            self.state     = state_response.json()
+        try:
+            map_future       = self._pool.submit(self._update_map)
+            indicator_future = self._pool.submit(self.http.get, URL_INDICATORS, headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+            state_future     = self._pool.submit(self.http.get, URL_STATE,      headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+            futures.extend([map_future, indicator_future, state_future])
             
             if comments:
-                self.get_comments()
+                comments_future = self._pool.submit(self._poll_comments)
+                futures.append(comments_future)
             else:
                 self.comments = []
             
             if events:
-                self.get_events()
+                events_future = self._pool.submit(self._poll_events)
+                futures.append(events_future)
             else:
                 self.events = {}
+            
+            self.indicators = loads(indicator_future.result().content)
+            self.state      = loads(state_future.result().content)
+            
+            if comments:
+                comments_future.result()
+            
+            if events:
+                events_future.result()
+            
+            map_future.result()
 
             if self.indicators['valid'] and self.state['valid']:
                 try:
                     # fix odd WT sign conventions
-                    try:
-                        self.indicators['aviahorizon_pitch'] = -self.indicators['aviahorizon_pitch']
-                    except KeyError:
-                        self.indicators['aviahorizon_pitch'] = 0
-                    
-                    try:
-                        self.indicators['aviahorizon_roll']  = -self.indicators['aviahorizon_roll']
-                    except KeyError:
-                        self.indicators['aviahorizon_roll']  = 0
+                    self.indicators['aviahorizon_pitch'] = -self.indicators.get('aviahorizon_pitch', 0)
+                    self.indicators['aviahorizon_roll']  = -self.indicators.get('aviahorizon_roll', 0)
                     
                     self.indicators['alt_m'] = self.find_altitude()
                     
-                    self.full_telemetry = combine_dicts(self.full_telemetry, self.indicators)
-                    self.full_telemetry = combine_dicts(self.full_telemetry, self.state)
-                    
-                    self.basic_telemetry['airframe'] = self.indicators['type']
-                    self.basic_telemetry['roll']     = self.indicators['aviahorizon_roll']
-                    self.basic_telemetry['pitch']    = self.indicators['aviahorizon_pitch']
-                    # self.basic_telemetry['heading']  = self.indicators['compass']
-                    self.basic_telemetry['altitude'] = self.indicators['alt_m']
-                
-                    self.basic_telemetry['lat'] = self.map_info.player_lat
-                    self.full_telemetry['lat']  = self.map_info.player_lat
-                    self.basic_telemetry['lon'] = self.map_info.player_lon
-                    self.full_telemetry['lon']  = self.map_info.player_lon
-                    
-                    try: 
-                        self.basic_telemetry['IAS'] = self.state['IAS, km/h']
-                    except KeyError:
-                        self.basic_telemetry['IAS'] = None
+                    self.full_telemetry = {**self.indicators,
+                                           **self.state,
+                                           'lat': self.map_info.player_lat,
+                                           'lon': self.map_info.player_lon}
                     
-                    try: 
-                        self.basic_telemetry['flapState'] = self.state['flaps, %']
-                    except KeyError:
-                        self.basic_telemetry['flapState'] = None
-                    
-                    try: 
-                        self.basic_telemetry['gearState'] = self.state['gear, %']
-                    except KeyError:
-                        self.basic_telemetry['gearState'] = None
+                    self.basic_telemetry = BasicTelemetry(airframe=self.indicators['type'],
+                                                          roll=self.indicators['aviahorizon_roll'],
+                                                          pitch=self.indicators['aviahorizon_pitch'],
+                                                          altitude=self.indicators['alt_m'],
+                                                          lat=self.map_info.player_lat,
+                                                          lon=self.map_info.player_lon,
+                                                          IAS=self.state.get('IAS, km/h'),
+                                                          flapState=self.state.get('flaps, %'),
+                                                          gearState=self.state.get('gear, %'))
                     
                     self.connected = True
                     self.status    = Status.IN_FLIGHT
@@ -234,13 +437,21 @@ class TelemInterface(object):
             else:
                 self.status = Status.NO_MISSION
 
-        except Exception as e:
-            if 'Failed to establish a new connection' in str(e):
-                self.status = Status.WT_NOT_RUNNING
-            else:
-                import traceback
-                traceback.print_exc()
-                self.status = Status.OTHER_ERROR
+        except (RequestsConnectionError, ConnectTimeout):
+            self.status = Status.WT_NOT_RUNNING
+
+        except ReadTimeout:
+            # WT is up but stalled (i.e. loading screen)
+            self.status = Status.OTHER_ERROR
+
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            self.status = Status.OTHER_ERROR
+        
+        finally:
+            # don't leave workers writing to shared state into the next poll
+            wait(futures)
         
         return self.connected
 
@@ -248,29 +459,60 @@ class TelemInterface(object):
         '''
         Return game status
         '''
+        
+        with self._poll_lock:
+            self._status_hint = self._poll_status()
+            return self._status_hint
+
+    def _poll_status(self) -> int:
+        '''
+        Query the localhost for the game status. While the previous status
+        was Status.IN_FLIGHT, only http://localhost:8111/indicators is checked
+        until a full check is due (every STATUS_REVALIDATE_POLLS calls)
+        '''
 
 
         self.connected       = False
         self.full_telemetry  = {}
-        self.basic_telemetry = {}
+        self.basic_telemetry = BasicTelemetry()
 
         try:
             
+            if (self._status_hint == Status.IN_FLIGHT) and (self._status_fast_polls < STATUS_REVALIDATE_POLLS):
+                self._status_fast_polls += 1
+                
+                indicator_response = self.http.get(URL_INDICATORS, headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+                self.indicators    = loads(indicator_response.content)
+                
+                if self.indicators['valid'] and ('type' in self.indicators):
+                    self._poll_events()
+                    self.basic_telemetry = BasicTelemetry(airframe=self.indicators['type'])
+                    
+                    self.connected = True
+                    return Status.IN_FLIGHT
+            
+            self._status_fast_polls = 0
+            
             if not self.map_info.check_battle():
                 return Status.IN_MENU
             
-            indicator_response = get(URL_INDICATORS)
-            self.indicators    = indicator_response.json()
-
-            state_response = get(URL_STATE)
-            self.state     = state_response.json()
+            # /state alone is enough to rule out a mission, so only query
+            # /indicators once it reports valid
+            state_response = self.http.get(URL_STATE, headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+            self.state     = loads(state_response.content)
+            
+            if not self.state['valid']:
+                return Status.NO_MISSION
             
-            self.get_events()
+            indicator_response = self.http.get(URL_INDICATORS, headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+            self.indicators    = loads(indicator_response.content)
             
-            if self.indicators['valid'] and self.state['valid']:
+            self._poll_events()
+            
+            if self.indicators['valid']:
                 try:
                                         
-                    self.basic_telemetry['airframe'] = self.indicators['type']
+                    self.basic_telemetry = BasicTelemetry(airframe=self.indicators['type'])
                     
                     self.connected = True
                     return Status.IN_FLIGHT
@@ -280,13 +522,14 @@ class TelemInterface(object):
             else:
                 return Status.NO_MISSION
 
-        except ConnectTimeout:
+        except (RequestsConnectionError, ConnectTimeout):
             return Status.WT_NOT_RUNNING
 
-        except Exception as e:
-            if 'Failed to establish a new connection' in str(e):
-                return Status.WT_NOT_RUNNING
-            else:
-                import traceback
-                traceback.print_exc()
-                return Status.OTHER_ERROR
+        except ReadTimeout:
+            # WT is up but stalled (i.e. loading screen)
+            return Status.OTHER_ERROR
+
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return Status.OTHER_ERROR